@@ -7,6 +7,7 @@ import (
 	"io"
 	"io/ioutil"
 	"log"
+	"math/rand"
 	"mime/multipart"
 	"net"
 	"net/http"
@@ -14,7 +15,6 @@ import (
 	"os"
 	"path/filepath"
 	"strconv"
-	"strings"
 	"sync"
 	"sync/atomic"
 	"time"
@@ -48,10 +48,21 @@ type Collector struct {
 
 	magicHeaderExtractionLength int
 
-	throttleMutex sync.Mutex
-	lastScanTime  time.Time
+	// The wanted file extensions and their distinct lengths, so that checking a path
+	// takes one lookup per length instead of a comparison with every extension
+	fileExtensionSet     map[string]struct{}
+	fileExtensionLengths []int
+
+	uploadUrl string
+	// multipartBoundary separates the parts of all uploads, since each request is parsed on its own
+	multipartBoundary string
+
+	throttleMutex   sync.Mutex
+	lastScanTime    time.Time
+	serverBusyUntil time.Time
 
 	fileHashCache *sync.Map
+	fileIDCache   *sync.Map
 }
 
 type CollectionStatistics struct {
@@ -67,17 +78,51 @@ func NewCollector(config CollectorConfig, logger *log.Logger) *Collector {
 		logger:          logger,
 		Statistics:      &CollectionStatistics{},
 		fileHashCache:   &sync.Map{},
+		fileIDCache:     &sync.Map{},
 	}
 	for _, header := range config.MagicHeaders {
 		if len(header) > collector.magicHeaderExtractionLength {
 			collector.magicHeaderExtractionLength = len(header)
 		}
 	}
+
+	collector.fileExtensionSet = make(map[string]struct{}, len(config.FileExtensions))
+	for _, extension := range config.FileExtensions {
+		if _, known := collector.fileExtensionSet[extension]; known {
+			continue
+		}
+		collector.fileExtensionSet[extension] = struct{}{}
+		var lengthKnown bool
+		for _, length := range collector.fileExtensionLengths {
+			if length == len(extension) {
+				lengthKnown = true
+				break
+			}
+		}
+		if !lengthKnown {
+			collector.fileExtensionLengths = append(collector.fileExtensionLengths, len(extension))
+		}
+	}
+
+	var urlParams = url.Values{}
+	if config.Source != "" {
+		urlParams.Add("source", config.Source)
+	}
+	var apiEndpoint string
+	if config.Sync {
+		apiEndpoint = "api/check"
+	} else {
+		apiEndpoint = "api/checkAsync"
+	}
+	collector.uploadUrl = fmt.Sprintf("%s/%s?%s", config.Server, apiEndpoint, urlParams.Encode())
+	collector.multipartBoundary = multipart.NewWriter(nil).Boundary()
 	return collector
 }
 
 // debugf calls logger.Printf if and only if debugging is enabled.
 // Arguments are handled in the manner of fmt.Printf.
+// Passing the arguments allocates even when debugging is disabled,
+// so calls that happen for each file are guarded with c.Debug.
 
 func (c *Collector) debugf(format string, params ...interface{}) {
 	if c.Debug {
@@ -85,18 +130,19 @@ func (c *Collector) debugf(format string, params ...interface{}) {
 	}
 }
 
+// uploadQueueLength is the number of files the walk may queue ahead of the upload workers.
+const uploadQueueLength = 1024
+
 func (c *Collector) StartWorkers() {
 	c.debugf("Starting %d threads for uploads", c.Threads)
 	c.workerGroup = &sync.WaitGroup{}
-	c.filesToUpload = make(chan infoWithPath)
+	// Buffer the queue so that the walk can keep going while all workers are busy uploading
+	c.filesToUpload = make(chan infoWithPath, uploadQueueLength)
 	for i := 0; i < c.Threads; i++ {
 		c.workerGroup.Add(1)
 		go func() {
 			for info := range c.filesToUpload {
-				shouldRedo := true
-				for shouldRedo {
-					shouldRedo = c.uploadToThunderstorm(info)
-				}
+				c.uploadToThunderstorm(info)
 			}
 			c.workerGroup.Done()
 		}()
@@ -127,15 +173,31 @@ func (c *Collector) CheckThunderstormUp() error {
 }
 
 func (c *Collector) Collect(root string) {
+	// Walking an absolute root yields absolute paths, so they don't need to be resolved per file
+	if abspath, err := filepath.Abs(root); err == nil {
+		root = abspath
+	}
 	c.logger.Printf("Walking through %s to find files to upload", root)
+	skippedDevices := make(map[uint64]bool)
 	err := filepath.Walk(root, func(path string, info os.FileInfo, err error) error {
 		if err != nil {
 			return nil
 		}
 		if !info.Mode().IsDir() {
-			c.filesToUpload <- infoWithPath{info, path, 0}
-		} else {
-			if !c.AllFilesystems && SkipFilesystem(path) {
+			if !c.skipFile(path, info) {
+				c.filesToUpload <- infoWithPath{info, path, 0}
+			}
+		} else if !c.AllFilesystems {
+			// All directories on a device share its filesystem, so it only needs to be checked once per device
+			id, hasID := getFileID(info)
+			skip, known := skippedDevices[id.device]
+			if !hasID || !known {
+				skip = SkipFilesystem(path)
+				if hasID {
+					skippedDevices[id.device] = skip
+				}
+			}
+			if skip {
 				c.logger.Printf("Skipping directory %s since it uses a pseudo or network filesystem", path)
 				return filepath.SkipDir
 			}
@@ -164,58 +226,135 @@ type infoWithPath struct {
 	retries int
 }
 
-var MB int64 = 1024 * 1024
+// fileID identifies a file by its device, inode, size and modification time.
+// Files with the same ID have the same content, so only one of them needs to be hashed.
+type fileID struct {
+	device  uint64
+	inode   uint64
+	size    int64
+	modTime int64
+}
+
+// copyBufferPool holds buffers for hashing file contents, so that hashing
+// a file doesn't allocate a fresh buffer for each file.
+var copyBufferPool = sync.Pool{
+	New: func() interface{} {
+		buffer := make([]byte, 64*1024)
+		return &buffer
+	},
+}
 
 func (c *Collector) throttle() {
-	if c.MinUploadPeriod > 0 {
-		for {
-			c.throttleMutex.Lock()
-			currentTime := time.Now()
-			timePassed := currentTime.Sub(c.lastScanTime)
-			if timePassed >= c.MinUploadPeriod {
-				c.lastScanTime = currentTime
-				c.throttleMutex.Unlock()
-				return
-			} else {
-				timeUntilNextUpload := c.MinUploadPeriod - timePassed
-				c.throttleMutex.Unlock()
-				time.Sleep(timeUntilNextUpload)
-			}
+	for {
+		c.throttleMutex.Lock()
+		currentTime := time.Now()
+		if currentTime.Before(c.serverBusyUntil) {
+			// Spread the workers' uploads over a second after the pause ends
+			timeUntilNextUpload := c.serverBusyUntil.Sub(currentTime) + time.Duration(rand.Int63n(int64(time.Second)))
+			c.throttleMutex.Unlock()
+			time.Sleep(timeUntilNextUpload)
+			continue
+		}
+		timePassed := currentTime.Sub(c.lastScanTime)
+		if timePassed >= c.MinUploadPeriod {
+			c.lastScanTime = currentTime
+			c.throttleMutex.Unlock()
+			return
+		} else {
+			timeUntilNextUpload := c.MinUploadPeriod - timePassed
+			c.throttleMutex.Unlock()
+			time.Sleep(timeUntilNextUpload)
 		}
 	}
 }
 
-func (c *Collector) uploadToThunderstorm(info infoWithPath) (redo bool) {
-	if !info.Mode().IsRegular() {
-		atomic.AddInt64(&c.Statistics.skippedFiles, 1)
-		c.debugf("Skipping irregular file %s", info.path)
-		return
+// pauseUploads delays all uploads, not only the current one, for the given duration.
+func (c *Collector) pauseUploads(duration time.Duration) {
+	c.throttleMutex.Lock()
+	pauseEnd := time.Now().Add(duration)
+	if pauseEnd.After(c.serverBusyUntil) {
+		c.serverBusyUntil = pauseEnd
 	}
-	isTooOld := true
-	for _, time := range getTimes(info.FileInfo) {
-		if time.After(c.ThresholdTime) {
-			isTooOld = false
-			break
-		}
+	c.throttleMutex.Unlock()
+}
+
+// maxRetryBackoff is the longest time to wait before retrying a failed upload.
+const maxRetryBackoff = 30 * time.Second
+
+// retryBackoff returns how long to wait before the next attempt after the given number of failed attempts.
+// The delay grows exponentially and is randomized so that workers don't retry in lockstep.
+func retryBackoff(retries int) time.Duration {
+	backoff := time.Second << uint(retries)
+	if backoff > maxRetryBackoff {
+		backoff = maxRetryBackoff
 	}
-	if isTooOld {
+	return backoff + time.Duration(rand.Int63n(int64(backoff/2)))
+}
+
+// skipFile checks whether a file can be skipped based on its metadata alone.
+// These checks run in the walk, so that skipped files are never queued for the upload workers.
+func (c *Collector) skipFile(path string, info os.FileInfo) bool {
+	if !info.Mode().IsRegular() {
 		atomic.AddInt64(&c.Statistics.skippedFiles, 1)
-		c.debugf("Skipping old file %s", info.path)
-		return
+		if c.Debug {
+			c.debugf("Skipping irregular file %s", path)
+		}
+		return true
 	}
+	// MaxFileSize is already given in bytes; the size is checked before the age,
+	// since it is a plain comparison while the times need to be extracted first
 	if c.MaxFileSize > 0 &&
-		c.MaxFileSize*MB < info.Size() {
+		c.MaxFileSize < info.Size() {
 		atomic.AddInt64(&c.Statistics.skippedFiles, 1)
-		c.debugf("Skipping big file %s", info.path)
-		return
+		if c.Debug {
+			c.debugf("Skipping big file %s", path)
+		}
+		return true
 	}
-	var extensionWanted bool
-	for _, extension := range c.FileExtensions {
-		if strings.HasSuffix(info.path, extension) {
-			extensionWanted = true
-			break
+	// Without a maximum age, no file is too old and its times don't need to be looked at
+	if !c.ThresholdTime.IsZero() {
+		isTooOld := true
+		for _, time := range getTimes(info) {
+			if time.After(c.ThresholdTime) {
+				isTooOld = false
+				break
+			}
+		}
+		if isTooOld {
+			atomic.AddInt64(&c.Statistics.skippedFiles, 1)
+			if c.Debug {
+				c.debugf("Skipping old file %s", path)
+			}
+			return true
+		}
+	}
+	return false
+}
+
+// hasWantedExtension checks whether the path ends with one of the configured file extensions.
+func (c *Collector) hasWantedExtension(path string) bool {
+	for _, length := range c.fileExtensionLengths {
+		if length > len(path) {
+			continue
+		}
+		if _, wanted := c.fileExtensionSet[path[len(path)-length:]]; wanted {
+			return true
 		}
 	}
+	return false
+}
+
+func (c *Collector) uploadToThunderstorm(info infoWithPath) {
+	extensionWanted := c.hasWantedExtension(info.path)
+	// Without magic headers, the extension alone decides and the file doesn't need to be opened
+	if !extensionWanted && len(c.MagicHeaders) == 0 && len(c.FileExtensions) > 0 {
+		if c.Debug {
+			c.debugf("Skipping file %s with unwanted extension", info.path)
+		}
+		atomic.AddInt64(&c.Statistics.skippedFiles, 1)
+		return
+	}
+
 	f, err := os.Open(info.path)
 	if err != nil {
 		c.logger.Printf("Could not open file %s: %v\n", info.path, err)
@@ -229,7 +368,9 @@ func (c *Collector) uploadToThunderstorm(info infoWithPath) (redo bool) {
 		headerBuffer := make([]byte, c.magicHeaderExtractionLength)
 		readLength, err := f.ReadAt(headerBuffer, 0)
 		if err != nil {
-			c.debugf("Could not read magic header for file %s", info.path)
+			if c.Debug {
+				c.debugf("Could not read magic header for file %s", info.path)
+			}
 		} else {
 			headerBuffer = headerBuffer[:readLength]
 			for _, magicHeader := range c.MagicHeaders {
@@ -241,63 +382,117 @@ func (c *Collector) uploadToThunderstorm(info infoWithPath) (redo bool) {
 		}
 	}
 
-	if !extensionWanted && !magicHeaderWanted && (len(c.MagicHeaders) > 0 || len(c.FileExtensions) > 0) {
-		c.debugf("Skipping file %s with unwanted extension and magic header", info.path)
+	if !extensionWanted && !magicHeaderWanted && len(c.MagicHeaders) > 0 {
+		if c.Debug {
+			c.debugf("Skipping file %s with unwanted extension and magic header", info.path)
+		}
 		atomic.AddInt64(&c.Statistics.skippedFiles, 1)
 		return
 	}
 
 	if info.Size() > c.MinCacheFileSize {
+		if id, ok := getFileID(info.FileInfo); ok {
+			if _, alreadyExists := c.fileIDCache.LoadOrStore(id, true); alreadyExists {
+				if c.Debug {
+					c.debugf("Skipping file %s since the same file was processed previously", info.path)
+				}
+				return
+			}
+		}
 		hashCalculator := sha256.New()
-		if _, err := io.Copy(hashCalculator, f); err == nil {
+		buffer := copyBufferPool.Get().(*[]byte)
+		// Hide the file's WriteTo method, which would make CopyBuffer ignore the pooled buffer
+		_, err := io.CopyBuffer(hashCalculator, struct{ io.Reader }{f}, *buffer)
+		copyBufferPool.Put(buffer)
+		if err == nil {
 			fileHash := string(hashCalculator.Sum(nil))
 			if _, alreadyExists := c.fileHashCache.LoadOrStore(fileHash, true); alreadyExists {
-				c.debugf("Skipping file %s since a file with the same content was processed previously", info.path)
+				if c.Debug {
+					c.debugf("Skipping file %s since a file with the same content was processed previously", info.path)
+				}
 				return
 			}
 		} else {
 			c.debugf("Could not calculate hash for file %s: %v", info.path, err)
 		}
-		// Reset file descriptor after hash calculation
+	}
+
+	// Only the upload itself is repeated on failure; the checks above don't need to be redone
+	for {
+		// Reset file descriptor after hash calculation or a previous attempt
 		f.Seek(0, io.SeekStart)
+		c.throttle()
+		if !c.sendToThunderstorm(&info, f) {
+			return
+		}
 	}
+}
 
-	c.throttle()
+// uploadBody is the request body for a file upload. Once finished, it refuses
+// further reads, since the transport may still read from it after the request returned.
+type uploadBody struct {
+	mutex    sync.Mutex
+	reader   io.Reader
+	finished bool
+}
 
-	var urlParams = url.Values{}
-	if c.Source != "" {
-		urlParams.Add("source", c.Source)
+func (b *uploadBody) Read(p []byte) (int, error) {
+	b.mutex.Lock()
+	defer b.mutex.Unlock()
+	if b.finished {
+		return 0, io.ErrClosedPipe
 	}
+	return b.reader.Read(p)
+}
 
-	var apiEndpoint string
-	if c.Sync {
-		apiEndpoint = "api/check"
-	} else {
-		apiEndpoint = "api/checkAsync"
-	}
+func (b *uploadBody) Close() error {
+	return nil
+}
 
-	url := fmt.Sprintf("%s/%s?%s", c.Server, apiEndpoint, urlParams.Encode())
+func (b *uploadBody) finish() {
+	b.mutex.Lock()
+	b.finished = true
+	b.mutex.Unlock()
+}
 
-	multipartReader, multipartWriter := io.Pipe()
-	w := multipart.NewWriter(multipartWriter)
-	abspath, err := filepath.Abs(info.path)
+func (c *Collector) sendToThunderstorm(info *infoWithPath, f *os.File) (redo bool) {
+	// Only the multipart framing is built in memory, the file content is streamed in between
+	var framing bytes.Buffer
+	w := multipart.NewWriter(&framing)
+	w.SetBoundary(c.multipartBoundary)
+	w.CreateFormFile("file", info.path)
+	headerLength := framing.Len()
+	w.Close()
+	// The file may have changed since it was listed, so its current size is used for the
+	// request's length. If it can't be determined, the request is sent chunked instead.
+	var fileContent io.Reader = f
+	contentLength := int64(-1)
+	if stat, err := f.Stat(); err == nil {
+		fileContent = io.LimitReader(f, stat.Size())
+		contentLength = int64(framing.Len()) + stat.Size()
+	}
+	body := &uploadBody{reader: io.MultiReader(
+		bytes.NewReader(framing.Bytes()[:headerLength]),
+		fileContent,
+		bytes.NewReader(framing.Bytes()[headerLength:]),
+	)}
+	request, err := http.NewRequest(http.MethodPost, c.uploadUrl, body)
 	if err != nil {
-		abspath = info.path
+		c.logger.Printf("Could not create request for file %s: %v", info.path, err)
+		atomic.AddInt64(&c.Statistics.uploadErrors, 1)
+		return false
 	}
-	go func() {
-		fw, err := w.CreateFormFile("file", abspath)
-		if err == nil {
-			io.Copy(fw, f)
-		}
-		w.Close()
-		multipartWriter.Close()
-	}()
-	response, err := http.Post(url, w.FormDataContentType(), multipartReader)
+	request.ContentLength = contentLength
+	request.Header.Set("Content-Type", w.FormDataContentType())
+	response, err := http.DefaultClient.Do(request)
+	// Make sure the file isn't read anymore before it's rewound for another attempt
+	body.finish()
 	if err != nil {
 		if info.retries < 3 {
-			c.logger.Printf("Could not send file %s to thunderstorm, will try again: %v", info.path, err)
+			backoff := retryBackoff(info.retries)
+			c.logger.Printf("Could not send file %s to thunderstorm, will try again in %v: %v", info.path, backoff.Round(time.Second), err)
 			info.retries++
-			time.Sleep(time.Second)
+			time.Sleep(backoff)
 			return true
 		} else {
 			c.logger.Printf("Could not send file %s to thunderstorm, canceling it.", info.path)
@@ -307,13 +502,16 @@ func (c *Collector) uploadToThunderstorm(info infoWithPath) (redo bool) {
 	}
 	defer response.Body.Close()
 	if response.StatusCode == http.StatusServiceUnavailable {
+		// Read the body completely so that the connection can be reused for the next attempt
+		io.Copy(ioutil.Discard, response.Body)
 		retryAfter := response.Header.Get("Retry-After")
 		retryTime, err := strconv.Atoi(retryAfter)
 		if err != nil {
 			retryTime = 30 // Default to 30 seconds cooldown time
 		}
 		c.logger.Printf("Thunderstorm has no free capacities for file %s, retrying in %d seconds", info.path, retryTime)
-		time.Sleep(time.Second * time.Duration(retryTime))
+		// The server is busy for every worker, so pause all of them instead of letting the others run into 503s as well
+		c.pauseUploads(time.Second * time.Duration(retryTime))
 		return true
 	}
 	responseBody, _ := ioutil.ReadAll(response.Body)
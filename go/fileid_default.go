@@ -0,0 +1,9 @@
+//+build !aix,!android,!darwin,!dragonfly,!freebsd,!illumos,!linux,!netbsd,!openbsd,!solaris
+
+package main
+
+import "os"
+
+func getFileID(info os.FileInfo) (fileID, bool) {
+	return fileID{}, false
+}
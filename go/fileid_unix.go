@@ -0,0 +1,21 @@
+//+build aix android darwin dragonfly freebsd illumos linux netbsd openbsd solaris
+
+package main
+
+import (
+	"os"
+	"syscall"
+)
+
+func getFileID(info os.FileInfo) (fileID, bool) {
+	stat, ok := info.Sys().(*syscall.Stat_t)
+	if !ok {
+		return fileID{}, false
+	}
+	return fileID{
+		device:  uint64(stat.Dev),
+		inode:   uint64(stat.Ino),
+		size:    info.Size(),
+		modTime: info.ModTime().UnixNano(),
+	}, true
+}
@@ -45,6 +45,9 @@ func buildHttpTransport(config Config) *http.Transport {
 	}
 	tlsConfig := &tls.Config{
 		InsecureSkipVerify: config.Insecure,
+		// New connections, e.g. after the server closed idle ones, resume a previous TLS session
+		// instead of doing a full handshake
+		ClientSessionCache: tls.NewLRUClientSessionCache(0),
 	}
 	if len(config.CAs) > 0 {
 		tlsConfig.RootCAs = caPool
@@ -56,10 +59,13 @@ func buildHttpTransport(config Config) *http.Transport {
 			KeepAlive: 30 * time.Second,
 		}).DialContext,
 		MaxIdleConns:          config.Threads,
+		MaxIdleConnsPerHost:   config.Threads,
 		IdleConnTimeout:       90 * time.Second,
 		TLSHandshakeTimeout:   10 * time.Second,
 		ExpectContinueTimeout: 1 * time.Second,
 		TLSClientConfig:       tlsConfig,
+		// Uploaded files are streamed through the connection's write buffer, which is only 4 KB by default
+		WriteBufferSize: 64 * 1024,
 	}
 	if config.Proxy != "" {
 		urlProxy, err := url.Parse(config.Proxy)
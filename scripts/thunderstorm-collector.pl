@@ -12,15 +12,15 @@
 # Usage examples:
 #   $> perl thunderstorm-collector.pl -- -s thunderstorm.internal.net
 #   $> perl thunderstorm-collector.pl -- --dir / --server thunderstorm.internal.net
+#   $> perl thunderstorm-collector.pl -- --dir / --server thunderstorm.internal.net --jobs 8
 
 use warnings;
 use strict;
 use Getopt::Long;
 use LWP::UserAgent;
+use HTTP::Request::Common ();
 use File::Spec::Functions qw( catfile );
 
-use Cwd; # module for finding the current working directory 
-
 # Configuration
 our $debug = 0;
 my $targetdir = "/";
@@ -29,19 +29,32 @@ my $port = 8080;
 my $scheme = "http";
 our $max_age = 3;       # in days
 our $max_size = 10;     # in megabytes
-our @skipElements = map { qr{$_} } ('^\/proc', '^\/mnt', '\.dat$', '\.npm');
+our $jobs = 4;          # number of parallel uploads
+our $max_retries = 3;   # retries after server errors (503 Server Busy is always retried)
+our @skipElements = ('^\/proc', '^\/mnt', '\.dat$', '\.npm');
+# All exclusions combined into a single regex, so that every path is matched only once
+our $skipElementsRegex = join('|', map { "(?:$_)" } @skipElements);
+$skipElementsRegex = qr{$skipElementsRegex};
+# Exclusions that aren't anchored to the end of the path also match everything below a matching
+# directory, so such directories can be skipped as a whole instead of checking each file in them
+our $skipDirsRegex = join('|', map { "(?:$_)" } grep { !/\$$/ } @skipElements) || '(?!)';
+$skipDirsRegex = qr{$skipDirsRegex};
 our @hardSkips = ('/proc', '/dev', '/sys');
+our %hardSkips = map { $_ => 1 } @hardSkips;
 
 # Command Line Parameters
 GetOptions("dir=s"      => \$targetdir,  # same for --dir or -d
            "server=s"   => \$server,     # same for --server or -s
            "port=i"     => \$port,       # same for --port or -p
+           "jobs=i"     => \$jobs,       # same for --jobs or -j
            "debug"      => \$debug       # --debug
           );
 
 # Composed Values
 our $api_endpoint = "$scheme://$server:$port/api/checkAsync";
 our $current_date = time;
+our $max_size_bytes = $max_size * 1024 * 1024;
+our $min_mdate = $current_date - ($max_age * 86400);
 
 # Stats
 our $num_submitted = 0;
@@ -49,97 +62,171 @@ our $num_processed = 0;
 
 # Objects
 our $ua;
+# Upload processes: the pipes that hand them file paths and the pipe on which idle ones report their number
+our @upload_pipes;
+our $ready_pipe;
 
 # Process Folders
 sub processDir { 
-    my ($workdir) = shift; 
-    my ($startdir) = &cwd; 
-    # keep track of where we began 
-    chdir($workdir) or do { print "[ERROR] Unable to enter dir $workdir:$!\n"; return; }; 
-    opendir(DIR, ".") or do { print "[ERROR] Unable to open $workdir:$!\n"; return; }; 
+    # Directories still to be processed, kept on a stack instead of recursing into each of them
+    my @dirs = (shift);
+    while ( defined(my $workdir = pop(@dirs)) ) {
+        # All entries are accessed by their full path, so there's no need to change into the directory
+        opendir(my $dh, $workdir) or do { print "[ERROR] Unable to open $workdir:$!\n"; next; }; 
     
-    my @names = readdir(DIR) or do { print "[ERROR] Unable to read $workdir:$!\n"; return; };
-    closedir(DIR); 
+        my @names = readdir($dh) or do { print "[ERROR] Unable to read $workdir:$!\n"; next; };
+        closedir($dh); 
     
-    foreach my $name (@names){ 
-        next if ($name eq "."); 
-        next if ($name eq ".."); 
-
-        #print("Workdir: $workdir Name: $name\n");
-        my $filepath = catfile($workdir, $name);
-        # Hard directory skips
-        my $skipHard = 0;
-        foreach ( @hardSkips ) { 
-            $skipHard = 1 if ( $filepath eq $_ ); 
-        }
-        next if $skipHard;
+        foreach my $name (@names){ 
+            next if ($name eq "."); 
+            next if ($name eq ".."); 
+
+            #print("Workdir: $workdir Name: $name\n");
+            my $filepath = catfile($workdir, $name);
+            # Hard directory skips
+            next if exists $hardSkips{$filepath};
         
-        # Is a Directory
-        if (-d $filepath){ 
-            #print "IS DIR!\n";
-            # Skip symbolic links
-            if (-l $filepath) { next; }
-            # Process Dir
-            &processDir($filepath); 
-            next; 
-        } else {
-            if ( $debug ) { print "[DEBUG] Checking $filepath ...\n"; }
-        }
+            # Characteristics (a single stat per entry, the checks below reuse its result)
+            # Entries that can't be accessed (e.g. broken links or vanished files) are skipped
+            my ($size, $mdate) = (stat($filepath))[7, 9] or next;
+            #print("SIZE: $size MDATE: $mdate\n");
 
-        # Characteristics 
-        my $size = (stat($filepath))[7];
-        my $mdate = (stat($filepath))[9];
-        #print("SIZE: $size MDATE: $mdate\n");
+            # Is a Directory
+            if (-d _){ 
+                #print "IS DIR!\n";
+                # Skip symbolic links
+                if (-l $filepath) { next; }
+                # Skip excluded directories
+                if ( $filepath =~ $skipDirsRegex ) {
+                    if ( $debug ) { print "[DEBUG] Skipping directory due to configured exclusion $filepath\n"; }
+                    next;
+                }
+                # Process Dir later
+                push(@dirs, $filepath);
+                next; 
+            } elsif ( ! -f _ ) {
+                # Skip sockets, pipes and devices, reading them would fail or block the upload
+                next;
+            } else {
+                if ( $debug ) { print "[DEBUG] Checking $filepath ...\n"; }
+            }
 
-        # Count
-        $num_processed++;
+            # Count
+            $num_processed++;
 
-        # Skip some files ----------------------------------------
-        # Skip Folders / elements
-        my $skipRegex = 0;
-        # Regex Checks
-        foreach ( @skipElements ) { 
-            if ( $filepath =~ $_ ) {
+            # Skip some files ----------------------------------------
+            # Skip Folders / elements
+            if ( $filepath =~ $skipElementsRegex ) {
                 if ( $debug ) { print "[DEBUG] Skipping file due to configured exclusion $filepath\n"; }
-                $skipRegex = 1;
-            } 
-        }
-        next if $skipRegex;
-        # Size
-        if ( ( $size / 1024 / 1024 ) gt $max_size ) {
-            if ( $debug ) { print "[DEBUG] Skipping file due to file size $filepath\n"; }
-            next;
-        }
-        # Age
-        #print("MDATE: $mdate CURR_DATE: $current_date\n");
-        if ( $mdate lt ( $current_date - ($max_age * 86400) ) ) {
-            if ( $debug ) { print "[DEBUG] Skipping file due to age $filepath\n"; }
-            next;
-        }       
-        
-        # Submit
-        &submitSample($filepath);
+                next;
+            }
 
-        chdir($startdir) or die "Unable to change back to dir $startdir:$!\n"; 
-    } 
+            # Size
+            if ( $size > $max_size_bytes ) {
+                if ( $debug ) { print "[DEBUG] Skipping file due to file size $filepath\n"; }
+                next;
+            }
+            # Age
+            #print("MDATE: $mdate MIN_MDATE: $min_mdate\n");
+            if ( $mdate < $min_mdate ) {
+                if ( $debug ) { print "[DEBUG] Skipping file due to age $filepath\n"; }
+                next;
+            }       
+        
+            # Submit
+            &submitSample($filepath);
+        } 
+    }
 } 
 
+sub startUploaders {
+    # The upload processes are started once and each of them keeps its connection to the server open
+    pipe($ready_pipe, my $ready_writer) or do { warn "Could not create pipe - $!"; return; };
+    # A failed upload process must not terminate the walk, its files are uploaded by the walk itself instead
+    $SIG{PIPE} = 'IGNORE';
+    for my $id ( 0 .. $jobs - 1 ) {
+        pipe(my $path_reader, my $path_writer) or do { warn "Could not create pipe - $!"; last; };
+        my $pid = fork();
+        if ( !defined $pid ) {
+            warn "Could not fork upload process - $!";
+            close($path_reader);
+            close($path_writer);
+            last;
+        }
+        if ( $pid == 0 ) {
+            close($ready_pipe);
+            close($path_writer);
+            close($_) for @upload_pipes;
+            # Paths are separated by NUL bytes, since file names may contain line breaks
+            local $/ = "\0";
+            while ( syswrite($ready_writer, pack("N", $id)) ) {
+                my $filepath = <$path_reader>;
+                last unless defined $filepath;
+                chomp($filepath);
+                &uploadSample($filepath);
+            }
+            exit 0;
+        }
+        close($path_reader);
+        push(@upload_pipes, $path_writer);
+    }
+    close($ready_writer);
+}
+
 sub submitSample {
     my ($filepath) = shift;
     print "[SUBMIT] Submitting $filepath ...\n";
-    eval { 
-        my $req = $ua->post($api_endpoint,
-            Content_Type => 'form-data',
-            Content => [
-                "file" => [ $filepath ],
-            ],
-        );
-        $num_submitted++;
-        print "\nError: ", $req->status_line unless $req->is_success;
-    } or do {
-        my $error = $@ || 'Unknown failure';
-        warn "Could not submit '$filepath' - $error";
-    };
+    $num_submitted++;
+    # Hand the file to the next idle upload process, so that the walk continues while uploading
+    if ( @upload_pipes ) {
+        my $id;
+        if ( ( sysread($ready_pipe, $id, 4) // 0 ) == 4 ) {
+            my $record = "$filepath\0";
+            return if ( syswrite($upload_pipes[unpack("N", $id)], $record) // 0 ) == length($record);
+        }
+        warn "Could not hand '$filepath' to an upload process";
+    }
+    &uploadSample($filepath);
+}
+
+sub uploadSample {
+    my ($filepath) = shift;
+    my $retries = 0;
+    while (1) {
+        my $req = eval { 
+            $ua->post($api_endpoint,
+                Content_Type => 'form-data',
+                Content => [
+                    "file" => [ $filepath ],
+                ],
+            );
+        } or do {
+            my $error = $@ || 'Unknown failure';
+            warn "Could not submit '$filepath' - $error";
+            return;
+        };
+        return if $req->is_success;
+        # Server errors (including failed connections) are retried, 503 Server Busy without a limit
+        if ( $req->code == 503 || ( $req->code >= 500 && $retries < $max_retries ) ) {
+            my $wait = $req->header('Retry-After');
+            if ( !defined $wait || $wait !~ /^\d+$/ ) {
+                if ( $req->code == 503 ) {
+                    $wait = 30;
+                } else {
+                    # Exponential backoff capped at 30 seconds, with jitter so that upload processes don't retry in lockstep
+                    $wait = 2 ** $retries;
+                    $wait = 30 if $wait > 30;
+                    $wait += rand(1);
+                }
+            }
+            $retries++ unless $req->code == 503;
+            print "[RETRY] Submission of $filepath failed with ", $req->status_line, ", retrying in ", int($wait), " seconds\n";
+            select(undef, undef, undef, $wait);
+            next;
+        }
+        print "\nError: ", $req->status_line;
+        return;
+    }
 }
 
 # MAIN ----------------------------------------------------------------
@@ -159,14 +246,30 @@ print "Thunderstorm Port: '$port'\n";
 print "Using API Endpoint: $api_endpoint\n";
 print "Maximum Age of Files: $max_age\n";
 print "Maximum File Size: $max_size\n";
+print "Parallel Uploads: $jobs\n";
 print "\n";
 
+# Flush output before forking upload processes
+$| = 1;
+
 # Instanciate an object 
-$ua = LWP::UserAgent->new;
+# Keep the connection to the server open between uploads
+$ua = LWP::UserAgent->new( keep_alive => 1 );
+# Stream the file content while sending instead of reading each file into memory first
+$HTTP::Request::Common::DYNAMIC_FILE_UPLOAD = 1;
+# Read the file in 64 KB chunks (the module default is 8 KB)
+$HTTP::Request::Common::READ_BUFFER_SIZE = 64 * 1024;
+# Start the upload processes before any connection is opened, so that they don't share one
+if ( $jobs > 1 ) {
+    &startUploaders();
+}
 
 print "Starting the walk at: $targetdir ...\n";
 # Start the walk
 &processDir($targetdir);
+# Let the upload processes finish their pending uploads and exit
+close($_) for @upload_pipes;
+1 while ( wait() != -1 );
 
 # End message
 my $end_date = time;
@@ -120,6 +120,9 @@ if ( $OutputPath -eq "" -or $OutputPath.Contains("Advanced Threat Protection") )
 # Maximum Size
 [int]$MaxSize = 20
 
+# Maximum number of retries after connection errors or server errors (503 Server Busy is always retried)
+[int]$MaxRetries = 3
+
 # Extensions
 # Recommended Preset
 [string[]]$Extensions = @('.asp','.vbs','.ps','.ps1','.rar','.tmp','.bas','.bat','.chm','.cmd','.com','.cpl','.crt','.dll','.exe','.hta','.js','.lnk','.msc','.ocx','.pcd','.pif','.pot','.reg','.scr','.sct','.sys','.url','.vb','.vbe','.vbs','.wsc','.wsf','.wsh','.ct','.t','.input','.war','.jsp','.php','.asp','.aspx','.doc','.docx','.pdf','.xls','.xlsx','.ppt','.pptx','.tmp','.log','.dump','.pwd','.w','.txt','.conf','.cfg','.conf','.config','.psd1','.psm1','.ps1xml','.clixml','.psc1','.pssc','.pl','.www','.rdp','.jar','.docm','.ace','.job','.temp','.plg','.asm')
@@ -226,26 +229,45 @@ Write-Log "Sending to URI: $($Url)" -Level "Debug"
 # Run THOR Thunderstorm Collector -------------------------------------
 # ---------------------------------------------------------------------
 $ProgressPreference = "SilentlyContinue"
+# Send the request body right away instead of waiting for a 100-Continue from the server
+[System.Net.ServicePointManager]::Expect100Continue = $False
+# Multipart framing shared by all uploads, a single boundary suffices since every request is parsed on its own
+$boundary = [System.Guid]::NewGuid().ToString();
+$LF = "`r`n";
+$ContentType = "multipart/form-data; boundary=`"$boundary`""
+$trailerBytes = [System.Text.Encoding]::UTF8.GetBytes("$LF--$boundary--$LF")
+# Size limit in bytes, so that each file's size is compared without a division
+$MaxSizeBytes = $MaxSize * 1MB
+# Oldest modification time to select, computed once instead of for every file
+if ( $MaxAge -gt 0 ) {
+    $MinLastWriteTime = (Get-Date).AddDays(-$MaxAge)
+}
+# Selected extensions as a set, so that each file needs a single lookup instead of a scan of the whole list
+# (case-insensitive like the -contains operator)
+$ExtensionSet = New-Object 'System.Collections.Generic.HashSet[string]' ([System.StringComparer]::OrdinalIgnoreCase)
+foreach ( $Extension in $Extensions ) {
+    [void]$ExtensionSet.Add($Extension)
+}
 try {
     Get-ChildItem -Path $Folder -File -Recurse -ErrorAction SilentlyContinue | 
     ForEach-Object {
         # -------------------------------------------------------------
         # Filter ------------------------------------------------------        
         # Size Check
-        if ( ( $_.Length / 1MB ) -gt $($MaxSize) ) {
+        if ( $_.Length -gt $MaxSizeBytes ) {
             Write-Log "$_ skipped due to size filter" -Level "Debug" 
             return
         }
         # Age Check 
         if ( $($MaxAge) -gt 0 ) {
-            if ( $_.LastWriteTime -lt (Get-Date).AddDays(-$($MaxAge)) ) {
+            if ( $_.LastWriteTime -lt $MinLastWriteTime ) {
                 Write-Log "$_ skipped due to age filter" -Level "Debug" 
                 return
             }
         }
         # Extensions Check
-        if ( $Extensions.Length -gt 0 ) {
-            if ( $Extensions -contains $_.extension ) { } else {
+        if ( $ExtensionSet.Count -gt 0 ) {
+            if ( $ExtensionSet.Contains($_.extension) ) { } else {
                 Write-Log "$_ skipped due to extension filter" -Level "Debug"
                 return
             }
@@ -255,46 +277,84 @@ try {
         # Submission --------------------------------------------------
         
         Write-Log "Processing $($_.FullName) ..." -Level "Debug"
-        # Reading the file data & preparing the request
+        # Opening the file & preparing the request
+        # The file content is streamed into the request instead of being read into memory
         try {
-            $fileBytes = [System.IO.File]::ReadAllBytes("$($_.FullName)");
+            $FileStream = [System.IO.File]::OpenRead("$($_.FullName)")
         } catch {
             Write-Log "Read Error: $_" -Level "Error"
+            return
         }
-        $fileEnc = [System.Text.Encoding]::GetEncoding('UTF-8').GetString($fileBytes);
-        $boundary = [System.Guid]::NewGuid().ToString();
-        $LF = "`r`n";
-        $bodyLines = ( 
+        $headerBytes = [System.Text.Encoding]::UTF8.GetBytes(( 
             "--$boundary",
             "Content-Disposition: form-data; name=`"file`"; filename=`"$($_.FullName)`"",
-            "Content-Type: application/octet-stream$LF",
-            $fileEnc,
-            "--$boundary--$LF" 
-        ) -join $LF
+            "Content-Type: application/octet-stream$LF$LF"
+        ) -join $LF)
 
         # Submitting the request
-        $StatusCode = 0
-        while ( $($StatusCode) -ne 200 ) {
-            try {
-                Write-Log "Submitting to Thunderstorm server: $($_.FullName) ..." -Level "Info"
-                $Response = Invoke-WebRequest -uri $($Url) -Method Post -ContentType "multipart/form-data; boundary=`"$boundary`"" -Body $bodyLines
-                $StatusCode = [int]$Response.StatusCode
-            } 
-            # Catch all non 200 status codes
-            catch {
-                $StatusCode = $_.Exception.Response.StatusCode.value__
-                if ( $StatusCode -eq 503 ) {
-                    $WaitSecs = 3
-                    if ( $_.Exception.Response.Headers['Retry-After'] ) {
-                        $WaitSecs = [int]$_.Exception.Response.Headers['Retry-After']
+        try {
+            $StatusCode = 0
+            $Retries = 0
+            # $_ refers to the error inside the catch block below
+            $FilePath = $_.FullName
+            while ( $($StatusCode) -ne 200 ) {
+                try {
+                    Write-Log "Submitting to Thunderstorm server: $($_.FullName) ..." -Level "Info"
+                    $FileStream.Position = 0
+                    $Request = [System.Net.HttpWebRequest]::Create($Url)
+                    $Request.Method = "POST"
+                    $Request.ContentType = $ContentType
+                    $Request.ContentLength = $headerBytes.Length + $FileStream.Length + $trailerBytes.Length
+                    $Request.AllowWriteStreamBuffering = $False
+                    $RequestStream = $Request.GetRequestStream()
+                    try {
+                        $RequestStream.Write($headerBytes, 0, $headerBytes.Length)
+                        $FileStream.CopyTo($RequestStream)
+                        $RequestStream.Write($trailerBytes, 0, $trailerBytes.Length)
+                    } finally {
+                        $RequestStream.Close()
+                    }
+                    $Response = $Request.GetResponse()
+                    $StatusCode = [int]$Response.StatusCode
+                    $Response.Close()
+                } 
+                # Catch all non 200 status codes
+                catch {
+                    $Exception = $_.Exception
+                    if ( $Exception.InnerException ) {
+                        $Exception = $Exception.InnerException
+                    }
+                    $StatusCode = $Exception.Response.StatusCode.value__
+                    $RetryAfter = $null
+                    if ( $Exception.Response ) {
+                        $RetryAfter = $Exception.Response.Headers['Retry-After']
+                        $Exception.Response.Close()
+                    }
+                    if ( $StatusCode -eq 503 ) {
+                        $WaitSecs = 3
+                        if ( $RetryAfter ) {
+                            $WaitSecs = [int]$RetryAfter
+                        }
+                        Write-Log "503: Server seems busy - retrying in $($WaitSecs) seconds"
+                        Start-Sleep -Seconds $($WaitSecs)
+                    } elseif ( $StatusCode -ge 400 -and $StatusCode -lt 500 ) {
+                        # The request itself was rejected, sending it again won't help
+                        Write-Log "$($StatusCode): Server rejected $($FilePath) - skipping it" -Level "Error"
+                        break
+                    } elseif ( $Retries -ge $MaxRetries ) {
+                        Write-Log "$($StatusCode): Server has problems - giving up on $($FilePath)" -Level "Error"
+                        break
+                    } else {
+                        # Exponential backoff with jitter: 1, 2, 4, ... seconds (at most 30) plus up to 1 second
+                        $WaitMillis = [Math]::Min(30, [Math]::Pow(2, $Retries)) * 1000 + (Get-Random -Maximum 1000)
+                        $Retries++
+                        Write-Log "$($StatusCode): Server has problems - retrying in $([Math]::Round($WaitMillis / 1000)) seconds"
+                        Start-Sleep -Milliseconds $WaitMillis
                     }
-                    Write-Log "503: Server seems busy - retrying in $($WaitSecs) seconds"
-                    Start-Sleep -Seconds $($WaitSecs)
-                } else {
-                    Write-Log "$($StatusCode): Server has problems - retrying in 3 seconds"
-                    Start-Sleep -Seconds 3
                 }
             }
+        } finally {
+            $FileStream.Close()
         }
      }
 } catch { 
@@ -18,6 +18,7 @@ LOG_TO_CMDLINE=1
 THUNDERSTORM_SERVER="ygdrasil.nextron"
 USE_SSL=0
 ASYNC_MODE=1
+MAX_UPLOAD_JOBS=4  # number of concurrent uploads
 
 # Target selection 
 declare -a SCAN_FOLDERS=('/root' '/tmp' '/home' '/var' '/usr');  # folders to scan 
@@ -37,7 +38,6 @@ function log {
     local type="$1"
     local message="$2"
     local ts
-    ts=$(timestamp)
 
     # Only report debug messages if mode is enabled
     if [ "$type" == "debug" ] && [ $DEBUG -ne 1 ]; then
@@ -53,8 +53,9 @@ function log {
         fi
     done
 
-    # Remove line breaks
-    message=$(echo "$message" | tr -d '\r' | tr '\n' ' ') 
+    # Remove line breaks (with parameter expansion, so that no subprocesses are needed)
+    message="${message//$'\r'/}"
+    message="${message//$'\n'/ }"
 
     # Remove prefix (e.g. [+])
     if [[ "${message:0:1}" == "[" ]]; then
@@ -65,6 +66,8 @@ function log {
 
     # Log to file
     if [[ $LOG_TO_FILE -eq 1 ]]; then
+        # The timestamp is only needed here, so it's only requested for messages written to the file
+        ts=$(timestamp)
         echo "$ts $type $message_cleaned" >> "$LOGFILE"
     fi
     # Log to syslog
@@ -86,6 +89,21 @@ function check_req
     fi
 }
 
+function submit_sample
+{
+    local file_path="$1"
+    local result
+    log debug "Submitting ${file_path} ..."
+    result=$(curl -s -X POST \
+             "$scheme://$THUNDERSTORM_SERVER:8080/api/$api_endpoint" \
+             --form "file=@${file_path};filename=${file_path}")
+    # If not 'id' in result
+    error="reason"
+    if [ "${result/$error}" != "$result" ]; then
+        log error "$result"
+    fi
+}
+
 # Program -------------------------------------------------------------
 
 echo "=============================================================="
@@ -111,6 +129,15 @@ log info "Transmitting samples to $THUNDERSTORM_SERVER"
 log info "Processing folders ${SCAN_FOLDERS[*]}"
 log info "Only check files created / modified within $MAX_AGE days"
 log info "Only process files smaller $MAX_FILE_SIZE KB"
+log info "Uploading up to $MAX_UPLOAD_JOBS files in parallel"
+
+# 'wait -n' (wait for any one upload) needs bash 4.3 or newer, older versions upload in batches
+WAIT_ANY=0
+if [ "${BASH_VERSINFO[0]}" -gt 4 ] || { [ "${BASH_VERSINFO[0]}" -eq 4 ] && [ "${BASH_VERSINFO[1]}" -ge 3 ]; }; then
+    WAIT_ANY=1
+else
+    log info "Bash $BASH_VERSION doesn't support 'wait -n', uploading in batches of $MAX_UPLOAD_JOBS files"
+fi
 
 # Check requirements
 check_req
@@ -128,25 +155,29 @@ fi
 # Loop over filesystem
 for scandir in "${SCAN_FOLDERS[@]}";
 do
-    find "$scandir" -type f  -mtime -$MAX_AGE 2> /dev/null | while read -r file_path
-    do
-        if [ -f "${file_path}" ]; then
-            # Check Size
-            filesize=$(du -k "$file_path" | cut -f1)
-            if [ "${filesize}" -gt $MAX_FILE_SIZE ]; then
-                continue
+    # Let find apply the type, age and size filters in one pass instead of
+    # spawning a 'du' for every file
+    find "$scandir" -type f -mtime -$MAX_AGE -size -$((MAX_FILE_SIZE + 1))k 2> /dev/null | {
+        running=0
+        while read -r file_path
+        do
+            if [ -f "${file_path}" ]; then
+                # Wait for a free upload slot before starting the next one
+                if [ $running -ge $MAX_UPLOAD_JOBS ]; then
+                    if [ $WAIT_ANY -eq 1 ]; then
+                        wait -n
+                        running=$((running - 1))
+                    else
+                        wait
+                        running=0
+                    fi
+                fi
+                # Submit sample
+                submit_sample "$file_path" &
+                running=$((running + 1))
             fi
-            log debug "Submitting ${file_path} ..."
-            # Submit sample
-            result=$(curl -s -X POST \
-                     "$scheme://$THUNDERSTORM_SERVER:8080/api/$api_endpoint" \
-                     --form "file=@${file_path};filename=${file_path}")
-            # If not 'id' in result
-            error="reason"
-            if [ "${result/$error}" != "$result" ]; then
-                log error "$result"
-            fi
-        fi
-    done 
+        done
+        wait
+    }
 done
 exit 0
\ No newline at end of file